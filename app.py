@@ -1,12 +1,23 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, Response
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import os
 import hmac
 import hashlib
 import base64
+import binascii
 import json
+import orjson
+import time
+import atexit
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, object_session
 from dotenv import load_dotenv
 
 # Configurare aplicație și bază de date
@@ -16,6 +27,9 @@ load_dotenv()
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///vehicles.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Only read by the local dev server in __main__
+FLASK_DEBUG = os.getenv('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes')
+
 db = SQLAlchemy(app)
 
 # Model baza de date
@@ -31,11 +45,110 @@ class Vehicle(db.Model):
     power = db.Column(db.String(20))
     type = db.Column(db.String(50))
 
+# Expression index so case-insensitive lookups are served by a B-tree index
+vehicle_lookup_index = db.Index(
+    'ix_vehicle_lookup',
+    func.lower(Vehicle.brand),
+    func.lower(Vehicle.model),
+    func.lower(Vehicle.type)
+)
+
+# In-memory tags of the vehicle catalog, keyed by lowercase (brand, model, type).
+# The catalog is small and mostly static, so webhooks look vehicles up here
+# instead of querying the database; the index is reloaded after the TTL expires.
+# Set VEHICLE_INDEX_TTL=0 to disable it and query the database on every lookup.
+VEHICLE_INDEX_TTL = int(os.getenv('VEHICLE_INDEX_TTL', 300))
+vehicle_index = {}
+vehicle_index_loaded_at = 0.0
+
+def build_tags(brand, model, vehicle_type, *details):
+    """Build the tag tuple for a vehicle, skipping empty details"""
+    # A dict keeps insertion order while dropping duplicates
+    tags = dict.fromkeys((brand, model, vehicle_type,
+                          f"{brand} {model}", f"{brand} {model} {vehicle_type}"))
+    for detail in details:
+        if detail:
+            tags[detail] = None
+    return tuple(tags)
+
+# Only the columns that end up in tags are selected, as plain rows instead of
+# ORM objects
+VEHICLE_TAG_COLUMNS = (Vehicle.brand, Vehicle.model, Vehicle.type, Vehicle.engine_code,
+                       Vehicle.fuel_type, Vehicle.displacement, Vehicle.generation)
+
+def vehicle_tags(vehicle):
+    """Build the tag tuple for a catalog vehicle row"""
+    return build_tags(vehicle.brand, vehicle.model, vehicle.type,
+                      vehicle.engine_code, vehicle.fuel_type,
+                      vehicle.displacement, vehicle.generation)
+
+def load_vehicle_index():
+    """Load the tags of every catalog vehicle into the in-memory lookup index"""
+    global vehicle_index, vehicle_index_loaded_at
+    index = {}
+    for vehicle in db.session.execute(select(*VEHICLE_TAG_COLUMNS).order_by(Vehicle.id)):
+        key = (vehicle.brand.lower(), vehicle.model.lower(), (vehicle.type or '').lower())
+        if key not in index:
+            index[key] = vehicle_tags(vehicle)
+    vehicle_index = index
+    vehicle_index_loaded_at = time.monotonic()
+    app.logger.info("Loaded %d vehicles into the lookup index", len(index))
+
+def find_vehicle_tags(brand, model, vehicle_type):
+    """Find the tags of a catalog vehicle by brand, model and type, ignoring case"""
+    if VEHICLE_INDEX_TTL <= 0:
+        vehicle = db.session.execute(
+            select(*VEHICLE_TAG_COLUMNS).where(
+                (func.lower(Vehicle.brand) == brand.lower()) &
+                (func.lower(Vehicle.model) == model.lower()) &
+                (func.lower(Vehicle.type) == vehicle_type.lower())
+            ).order_by(Vehicle.id).limit(1)
+        ).first()
+        return vehicle_tags(vehicle) if vehicle else None
+    return get_vehicle_index().get((brand.lower(), model.lower(), vehicle_type.lower()))
+
+def get_vehicle_index():
+    """Return the vehicle lookup index, reloading it once the TTL has expired"""
+    if time.monotonic() - vehicle_index_loaded_at > VEHICLE_INDEX_TTL:
+        load_vehicle_index()
+    return vehicle_index
+
+# Catalog writes expire the index when they are committed, not when they are
+# flushed: a reload between the flush and the commit would otherwise cache the
+# old catalog as fresh, and a rolled back write must not expire it at all.
+# Writes from other processes are still picked up through the TTL.
+@event.listens_for(Vehicle, 'after_insert')
+@event.listens_for(Vehicle, 'after_update')
+@event.listens_for(Vehicle, 'after_delete')
+def mark_vehicle_catalog_changed(mapper, connection, target):
+    """Remember that the session has written to the vehicle catalog"""
+    session = object_session(target)
+    if session is not None:
+        session.info['vehicle_catalog_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def expire_vehicle_index(session):
+    """Reload the vehicle index on next use after a committed catalog write"""
+    global vehicle_index_loaded_at
+    if session.info.pop('vehicle_catalog_changed', False):
+        vehicle_index_loaded_at = float('-inf')
+
+@event.listens_for(Session, 'after_rollback')
+def forget_vehicle_catalog_changes(session):
+    """Drop the pending catalog change of a rolled back transaction"""
+    session.info.pop('vehicle_catalog_changed', None)
+
 # Inițializare baza de date (fără date mock)
 with app.app_context():
     db.create_all()
+    if VEHICLE_INDEX_TTL > 0:
+        load_vehicle_index()
 
 # Încărcare configurație din fișier
+# See config.example.json. "patterns" maps each field to a regex,
+# "non_vehicle_keywords" lists words that mark a title as not a vehicle part,
+# and the optional "vocabularies" maps a field to literal terms that are
+# matched instead of that field's regex.
 CONFIG_PATH = os.getenv('CONFIG_PATH', 'config.json')
 try:
     with open(CONFIG_PATH, 'r') as config_file:
@@ -54,175 +167,610 @@ except FileNotFoundError:
         "non_vehicle_keywords": ["shirt", "book", "phone", "laptop", "jacket", "toy"]
     }
 
+# Compile the configured patterns once at import instead of on every webhook
+COMPILED_PATTERNS = {
+    key: re.compile(pattern, re.IGNORECASE)
+    for key, pattern in config['patterns'].items()
+}
+NON_WORD_RE = re.compile(r'\W+')
+# ASCII titles are normalized with a byte translation table instead of the
+# regex: every byte that is not a word character becomes a space
+ASCII_WORD_BYTES = frozenset(b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+NON_WORD_BYTES_TABLE = bytes(c if c in ASCII_WORD_BYTES else 0x20 for c in range(256))
+
+def build_vocabulary_trie(vocabularies):
+    """Build a word-level trie from literal per-field vocabularies"""
+    trie = {}
+    for field, terms in vocabularies.items():
+        for term in terms:
+            words = NON_WORD_RE.sub(' ', term).lower().split()
+            if not words:
+                continue
+            node = trie
+            for word in words:
+                node = node.setdefault(word, {})
+            # The None key marks the end of a term and lists its fields
+            node.setdefault(None, []).append(field)
+    return trie
+
+# Optional literal vocabularies (e.g. known brands or engine codes) are matched
+# with a single trie walk over the title words instead of a regex alternation
+VOCABULARY_FIELDS = frozenset(config.get('vocabularies', {}))
+VOCABULARY_TRIE = build_vocabulary_trie(config.get('vocabularies', {}))
+
+def compile_non_vehicle_keywords(keywords):
+    """Compile the keywords into one case-insensitive whole-word regex"""
+    alternatives = []
+    for keyword in keywords:
+        keyword_words = NON_WORD_RE.sub(' ', keyword).split()
+        if keyword_words:
+            # Words of a multi-word keyword may be separated by any non-word run
+            alternatives.append(r'\W+'.join(re.escape(word) for word in keyword_words))
+    if not alternatives:
+        return None
+    return re.compile(rf"\b(?:{'|'.join(alternatives)})\b", re.IGNORECASE)
+
+# Non-vehicle keywords are matched as whole words in a single regex pass over
+# the raw title, without lowercasing or splitting it first
+NON_VEHICLE_RE = compile_non_vehicle_keywords(config['non_vehicle_keywords'])
+
 # Configurare Shopify
 SHOPIFY_DOMAIN = os.getenv("SHOPIFY_DOMAIN")
 ACCESS_TOKEN = os.getenv("SHOPIFY_ACCESS_TOKEN")
 SHOPIFY_SECRET = os.getenv("SHOPIFY_SECRET")  # Webhook secret for verification
+SHOPIFY_SECRET_BYTES = SHOPIFY_SECRET.encode('utf-8') if SHOPIFY_SECRET else None
+SHOPIFY_API_BASE = f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10"
+SHOPIFY_GRAPHQL_URL = f"{SHOPIFY_API_BASE}/graphql.json"
+SHOPIFY_COLLECTIONS_URL = f"{SHOPIFY_API_BASE}/custom_collections.json"
+
+# One pooled session for all Shopify calls, so connections (and their TLS
+# handshakes) are reused across webhooks; throttled and failed calls are retried
+shopify_session = requests.Session()
+shopify_session.headers.update({
+    "Content-Type": "application/json",
+    "X-Shopify-Access-Token": ACCESS_TOKEN
+})
+shopify_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Shared pool for the per-tag collection calls, so one webhook's Shopify
+# round-trips overlap instead of running back to back
+collection_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('COLLECTION_WORKERS', 5)),
+    thread_name_prefix='collections'
+)
+
+# Webhooks are acknowledged as soon as they are verified and tagged; the
+# Shopify updates for each product run on this pool, off the request path
+webhook_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('WEBHOOK_WORKERS', 4)),
+    thread_name_prefix='webhooks'
+)
+
+# With REDIS_URL set, webhook work is queued in Redis and processed by
+# `rq worker --with-scheduler autotag`, so it survives restarts and is retried
+# on failure. Retries are scheduled with a delay, and only a worker started
+# with --with-scheduler ever runs them.
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    from redis import Redis
+    from rq import Queue, Retry as JobRetry
+    webhook_queue = Queue('autotag', connection=Redis.from_url(REDIS_URL))
+else:
+    webhook_queue = None
+
+class BatchQueue:
+    """Collect items for a short window and hand them to a flush function together"""
+
+    def __init__(self, flush, window, max_size):
+        self._flush = flush
+        self._window = window
+        self._max_size = max_size
+        self._items = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, key, item):
+        """Queue an item; a later item with the same key replaces it.
+
+        Returns a Future that is resolved once the batch holding the item is
+        sent, or carries the exception if sending it failed.
+        """
+        future = Future()
+        with self._lock:
+            futures = self._items[key][1] if key in self._items else []
+            futures.append(future)
+            self._items[key] = (item, futures)
+            if len(self._items) >= self._max_size:
+                items = self._take()
+            else:
+                items = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self._window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if items:
+            self._run(items)
+        return future
+
+    def flush(self):
+        """Send everything queued so far"""
+        with self._lock:
+            items = self._take()
+        if items:
+            self._run(items)
+
+    def _take(self):
+        items = list(self._items.values())
+        self._items = {}
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return items
+
+    def _run(self, entries):
+        # Failures are handed to the callers through their futures instead of
+        # being dropped here
+        try:
+            self._flush([item for item, _ in entries])
+        except Exception as e:
+            for _, futures in entries:
+                for future in futures:
+                    future.set_exception(e)
+        else:
+            for _, futures in entries:
+                for future in futures:
+                    future.set_result(None)
+
+# Collections this process has already created or updated, by title, with the
+# time each entry expires. The collection payload depends only on the title and
+# tag, so a cached collection needs no API calls until its entry expires.
+COLLECTION_CACHE_TTL = int(os.getenv('COLLECTION_CACHE_TTL', 3600))
+collection_cache = {}
+collection_cache_lock = threading.Lock()
+# A fixed pool of locks, picked by title hash, so memory stays bounded however
+# many collection titles a long-lived worker sees
+COLLECTION_LOCK_STRIPES = 64
+collection_title_locks = [threading.Lock() for _ in range(COLLECTION_LOCK_STRIPES)]
 
 def verify_webhook(data, hmac_header):
     """Verify the Shopify webhook signature"""
-    digest = hmac.new(
-        SHOPIFY_SECRET.encode('utf-8'),
-        data,
-        hashlib.sha256
-    ).digest()
-    computed_hmac = base64.b64encode(digest).decode('utf-8')
-    return hmac.compare_digest(computed_hmac, hmac_header)
+    if not SHOPIFY_SECRET_BYTES:
+        app.logger.error("SHOPIFY_SECRET is not set; rejecting webhook")
+        return False
+    try:
+        provided = base64.b64decode(hmac_header, validate=True)
+    except (binascii.Error, ValueError):
+        return False
+    digest = hmac.new(SHOPIFY_SECRET_BYTES, data, hashlib.sha256).digest()
+    return hmac.compare_digest(digest, provided)
+
+# The same brand, model and engine snippets get normalized over and over
+NORMALIZE_CACHE_SIZE = int(os.getenv('NORMALIZE_CACHE_SIZE', 4096))
 
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_text(text):
     """Normalize text for safe comparisons"""
     if not text:
         return None
-    return re.sub(r'\W+', ' ', text).strip().lower()
+    if text.isascii():
+        return ' '.join(text.encode('ascii').translate(NON_WORD_BYTES_TABLE).decode('ascii').lower().split())
+    return NON_WORD_RE.sub(' ', text).strip().lower()
+
+def match_vocabulary(text):
+    """Find the first (longest) vocabulary term for each field in normalized text"""
+    found = {}
+    words = text.split() if text else []
+    for start in range(len(words)):
+        node = VOCABULARY_TRIE
+        longest = None
+        for end in range(start, len(words)):
+            node = node.get(words[end])
+            if node is None:
+                break
+            if None in node:
+                longest = (end, node[None])
+        if longest:
+            end, fields = longest
+            term = ' '.join(words[start:end + 1])
+            for field in fields:
+                found.setdefault(field, term)
+            if len(found) == len(VOCABULARY_FIELDS):
+                break
+    return found
+
+def is_non_vehicle_title(title):
+    """Check a product title against the non-vehicle keywords"""
+    return bool(NON_VEHICLE_RE and NON_VEHICLE_RE.search(title))
+
+# Fields the fallback word loop can fill; it stops once all of them are set
+FALLBACK_FIELDS = ('brand', 'model', 'type', 'engine', 'engine_code')
+# A field may have no pattern (a config can cover it with a vocabulary only);
+# the fallback then leaves that field alone
+BRAND_RE, MODEL_RE, TYPE_RE, ENGINE_RE, ENGINE_CODE_RE = (
+    COMPILED_PATTERNS.get(field) for field in FALLBACK_FIELDS
+)
 
 def extract_vehicle_data(title):
-    """Extract vehicle data using configurable regex patterns"""
-    app.logger.info(f"Processing product title: '{title}'")
-    if not title or any(keyword in title.lower() for keyword in config['non_vehicle_keywords']):
-        app.logger.info("Skipping non-vehicle product title")
+    """Extract vehicle data using configurable regex patterns.
+
+    Non-vehicle titles are filtered out by the webhook handler before this is
+    called (see is_non_vehicle_title).
+    """
+    app.logger.info("Processing product title: '%s'", title)
+    if not title:
         return {'brand': None, 'model': None, 'generation': None, 'engine': None, 'engine_code': None, 'type': None}
 
-    patterns = config['patterns']
     result = {}
-    for key, pattern in patterns.items():
-        match = re.search(pattern, title, re.IGNORECASE)
+    if VOCABULARY_FIELDS:
+        vocabulary_matches = match_vocabulary(normalize_text(title))
+        for key in VOCABULARY_FIELDS:
+            result[key] = vocabulary_matches.get(key)
+    for key, pattern in COMPILED_PATTERNS.items():
+        if key in VOCABULARY_FIELDS:
+            continue
+        match = pattern.search(title)
         result[key] = normalize_text(match.group(0)) if match else None
     
     # Fallback logic to guess fields if patterns don't match
     if not result.get('brand') or not result.get('model') or not result.get('type'):
         words = title.split()
+        last = len(words) - 1
         for i, word in enumerate(words):
-            if not result.get('brand') and re.match(patterns['brand'], word, re.IGNORECASE):
+            if all(result.get(field) for field in FALLBACK_FIELDS):
+                break
+            if not result.get('brand') and BRAND_RE and BRAND_RE.match(word):
                 result['brand'] = normalize_text(word)
-            elif (result.get('brand') or i > 0) and not result.get('model') and re.match(patterns['model'], word, re.IGNORECASE):
+            elif (result.get('brand') or i > 0) and not result.get('model') and MODEL_RE and MODEL_RE.match(word):
                 result['model'] = normalize_text(word)
-            elif not result.get('type') and re.match(patterns['type'], word + (f" {words[i+1]}" if i+1 < len(words) else ""), re.IGNORECASE):
-                result['type'] = normalize_text(word + (f" {words[i+1]}" if i+1 < len(words) else ""))
-            elif not result.get('engine') and re.match(patterns['engine'], word, re.IGNORECASE):
+            elif not result.get('type') and TYPE_RE and TYPE_RE.match(
+                    pair := (f"{word} {words[i+1]}" if i < last else word)):
+                result['type'] = normalize_text(pair)
+            elif not result.get('engine') and ENGINE_RE and ENGINE_RE.match(word):
                 result['engine'] = normalize_text(word)
-            elif not result.get('engine_code') and re.match(patterns['engine_code'], word, re.IGNORECASE):
+            elif not result.get('engine_code') and ENGINE_CODE_RE and ENGINE_CODE_RE.match(word):
                 result['engine_code'] = normalize_text(word)
     
-    app.logger.info(f"Extracted vehicle data: {result}")
+    app.logger.info("Extracted vehicle data: %s", result)
     return result
 
 def get_vehicle_tags(vehicle_data):
     """Generate tags based on vehicle data"""
-    tags = set()
-    app.logger.info(f"vehicle_data in get_vehicle_tags: {vehicle_data}")
+    app.logger.info("vehicle_data in get_vehicle_tags: %s", vehicle_data)
 
     required_fields = ['brand', 'model', 'type']
     if not all(vehicle_data.get(field) for field in required_fields):
-        app.logger.warning(f"Skipping query due to missing vehicle data: {vehicle_data}")
-        return list(tags)
-
-    vehicle = Vehicle.query.filter(
-        (Vehicle.brand.ilike(vehicle_data['brand'])) &
-        (Vehicle.model.ilike(vehicle_data['model'])) &
-        (Vehicle.type.ilike(vehicle_data['type']))
-    ).first()
-
-    if vehicle:
-        tags.add(vehicle.brand)
-        tags.add(vehicle.model)
-        tags.add(vehicle.type)
-        tags.add(f"{vehicle.brand} {vehicle.model}")
-        tags.add(f"{vehicle.brand} {vehicle.model} {vehicle.type}")
-        if vehicle.engine_code:
-            tags.add(vehicle.engine_code)
-        if vehicle.fuel_type:
-            tags.add(vehicle.fuel_type)
-        if vehicle.displacement:
-            tags.add(vehicle.displacement)
-        if vehicle.generation:
-            tags.add(vehicle.generation)
-    else:
+        app.logger.warning("Skipping query due to missing vehicle data: %s", vehicle_data)
+        return ()
+
+    tags = find_vehicle_tags(vehicle_data['brand'], vehicle_data['model'], vehicle_data['type'])
+    if tags is None:
         # If no vehicle is found in the database, use extracted data to generate basic tags
-        tags.add(vehicle_data['brand'])
-        tags.add(vehicle_data['model'])
-        tags.add(vehicle_data['type'])
-        tags.add(f"{vehicle_data['brand']} {vehicle_data['model']}")
-        tags.add(f"{vehicle_data['brand']} {vehicle_data['model']} {vehicle_data['type']}")
-        if vehicle_data.get('engine_code'):
-            tags.add(vehicle_data['engine_code'])
-        if vehicle_data.get('fuel_type'):
-            tags.add(vehicle_data['fuel_type'])
-        if vehicle_data.get('displacement'):
-            tags.add(vehicle_data['displacement'])
-        if vehicle_data.get('generation'):
-            tags.add(vehicle_data['generation'])
-        
-    return list(tags)
+        tags = build_tags(vehicle_data['brand'], vehicle_data['model'], vehicle_data['type'],
+                          vehicle_data.get('engine_code'), vehicle_data.get('fuel_type'),
+                          vehicle_data.get('displacement'), vehicle_data.get('generation'))
+    return tags
+
+# Product titles repeat a lot (re-published products, retried webhooks, bulk
+# imports), so tags are cached per title for as long as the catalog is unchanged
+TAG_CACHE_SIZE = int(os.getenv('TAG_CACHE_SIZE', 10000))
+
+@functools.lru_cache(maxsize=TAG_CACHE_SIZE)
+def _compute_tags_cached(title, index_loaded_at):
+    # index_loaded_at is only part of the cache key: a reloaded vehicle index
+    # gets fresh entries and the stale ones age out of the LRU
+    return get_vehicle_tags(extract_vehicle_data(title))
+
+def compute_tags(title):
+    """Compute the tags for a product title"""
+    if VEHICLE_INDEX_TTL <= 0:
+        # Vehicles are read straight from the database, so nothing is cached
+        return get_vehicle_tags(extract_vehicle_data(title))
+    get_vehicle_index()
+    return _compute_tags_cached(title, vehicle_index_loaded_at)
+
+# GraphQL calls are POSTs, which the session's Retry does not repeat, and
+# Shopify reports throttling as HTTP 200 with a THROTTLED error, so throttled
+# and failed GraphQL requests are retried here with backoff
+GRAPHQL_RETRIES = int(os.getenv('GRAPHQL_RETRIES', 4))
+GRAPHQL_RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+GRAPHQL_MAX_RETRY_DELAY = 30.0
+
+def is_throttled(body):
+    """Check whether a GraphQL response was rejected by Shopify's rate limit"""
+    errors = body.get('errors')
+    return isinstance(errors, list) and any(
+        isinstance(error, dict) and error.get('extensions', {}).get('code') == 'THROTTLED'
+        for error in errors
+    )
+
+def graphql_retry_delay(attempt, response, body=None):
+    """Seconds to wait before retrying a throttled or failed GraphQL request"""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(float(retry_after), GRAPHQL_MAX_RETRY_DELAY)
+        except ValueError:
+            pass
+    # A throttled response says how many points are missing and how fast they
+    # come back
+    cost = (body or {}).get('extensions', {}).get('cost', {})
+    throttle_status = cost.get('throttleStatus') or {}
+    restore_rate = throttle_status.get('restoreRate')
+    if restore_rate:
+        missing = cost.get('requestedQueryCost', 0) - throttle_status.get('currentlyAvailable', 0)
+        if missing > 0:
+            return min(missing / restore_rate, GRAPHQL_MAX_RETRY_DELAY)
+    return min(0.5 * 2 ** attempt, GRAPHQL_MAX_RETRY_DELAY)
+
+def shopify_graphql(query, variables):
+    """Run a Shopify Admin GraphQL request and return its data"""
+    payload = orjson.dumps({"query": query, "variables": variables})
+    for attempt in range(GRAPHQL_RETRIES + 1):
+        can_retry = attempt < GRAPHQL_RETRIES
+        try:
+            response = shopify_session.post(SHOPIFY_GRAPHQL_URL, data=payload)
+        except requests.exceptions.ConnectionError as e:
+            # The mutations only set tags and collection membership, so
+            # sending one again is safe
+            if not can_retry:
+                raise
+            delay = min(0.5 * 2 ** attempt, GRAPHQL_MAX_RETRY_DELAY)
+            app.logger.warning("Shopify GraphQL request failed (%s), retrying in %.1fs", e, delay)
+            time.sleep(delay)
+            continue
+        if can_retry and response.status_code in GRAPHQL_RETRY_STATUSES:
+            delay = graphql_retry_delay(attempt, response)
+        else:
+            response.raise_for_status()
+            body = orjson.loads(response.content)
+            if not body.get('errors'):
+                return body['data']
+            if not (can_retry and is_throttled(body)):
+                raise requests.exceptions.RequestException(f"GraphQL errors: {body['errors']}")
+            delay = graphql_retry_delay(attempt, response, body)
+        app.logger.warning("Shopify GraphQL request throttled or failed (HTTP %s), retrying in %.1fs",
+                           response.status_code, delay)
+        time.sleep(delay)
+
+def find_collection_id(collection_title):
+    """Find a custom collection by title, following Shopify's pagination"""
+    url = SHOPIFY_COLLECTIONS_URL
+    # Let Shopify filter by title and return only the fields we read
+    params = {"title": collection_title, "fields": "id,title", "limit": 250}
+    while url:
+        response = shopify_session.get(url, params=params)
+        response.raise_for_status()
+        for collection in orjson.loads(response.content).get('custom_collections', []):
+            if collection['title'] == collection_title:
+                return collection['id']
+        # The next page link already carries the page_info cursor
+        url = response.links.get('next', {}).get('url')
+        params = None
+    return None
+
+def get_cached_collection_id(collection_title):
+    """Return the cached id of a collection, or None if missing or expired"""
+    with collection_cache_lock:
+        cached = collection_cache.get(collection_title)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
 
 def create_or_update_collection(collection_title, tag):
     """Create or update a Shopify collection based on a tag"""
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": ACCESS_TOKEN
-    }
-    response = requests.get(
-        f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/custom_collections.json",
-        headers=headers
-    )
-    response.raise_for_status()
-    collections = response.json().get('custom_collections', [])
-
-    collection_id = None
-    for collection in collections:
-        if collection['title'] == collection_title:
-            collection_id = collection['id']
-            break
-
-    payload = {
-        "custom_collection": {
-            "title": collection_title,
-            "collects": [],
-            "rule_set": {
-                "applied_disjunctively": False,
-                "rules": [
-                    {
-                        "column": "tag",
-                        "relation": "equals",
-                        "condition": tag
-                    }
-                ]
+    collection_id = get_cached_collection_id(collection_title)
+    if collection_id:
+        return collection_id
+
+    title_lock = collection_title_locks[hash(collection_title) % COLLECTION_LOCK_STRIPES]
+    # Only one thread looks up and creates a given collection. Concurrent
+    # webhooks for the same tag wait here and then find it in the cache, instead
+    # of each missing it and creating a duplicate collection.
+    with title_lock:
+        collection_id = get_cached_collection_id(collection_title)
+        if collection_id:
+            return collection_id
+
+        collection_id = find_collection_id(collection_title)
+
+        payload = {
+            "custom_collection": {
+                "title": collection_title,
+                "collects": [],
+                "rule_set": {
+                    "applied_disjunctively": False,
+                    "rules": [
+                        {
+                            "column": "tag",
+                            "relation": "equals",
+                            "condition": tag
+                        }
+                    ]
+                }
             }
         }
-    }
 
-    if collection_id:
-        response = requests.put(
-            f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/custom_collections/{collection_id}.json",
-            json=payload,
-            headers=headers
-        )
-    else:
-        response = requests.post(
-            f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/custom_collections.json",
-            json=payload,
-            headers=headers
+        if collection_id:
+            response = shopify_session.put(
+                f"{SHOPIFY_API_BASE}/custom_collections/{collection_id}.json",
+                data=orjson.dumps(payload)
+            )
+        else:
+            response = shopify_session.post(
+                SHOPIFY_COLLECTIONS_URL,
+                data=orjson.dumps(payload)
+            )
+        response.raise_for_status()
+        collection_id = orjson.loads(response.content)['custom_collection']['id']
+        with collection_cache_lock:
+            collection_cache[collection_title] = (collection_id, time.monotonic() + COLLECTION_CACHE_TTL)
+        return collection_id
+
+# Each collectionAddProducts costs about 10 points and Shopify rejects any single
+# query above 1000, so a batch is split into requests of at most this many
+# collections
+COLLECTIONS_PER_REQUEST = int(os.getenv('COLLECTIONS_PER_REQUEST', 50))
+
+def add_products_to_collections(collects):
+    """Add products to collections with aliased collectionAddProducts mutations"""
+    product_ids_by_collection = {}
+    for collection_id, product_id in collects:
+        product_ids_by_collection.setdefault(collection_id, []).append(f"gid://shopify/Product/{product_id}")
+
+    collections = list(product_ids_by_collection.items())
+    error = None
+    for start in range(0, len(collections), COLLECTIONS_PER_REQUEST):
+        # Send the remaining chunks even if one fails, then report the failure
+        try:
+            send_collection_additions(collections[start:start + COLLECTIONS_PER_REQUEST])
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+
+def send_collection_additions(collections):
+    """Send one aliased collectionAddProducts request for (collection id, product ids) pairs"""
+    variables = {}
+    declarations = []
+    mutations = []
+    for i, (collection_id, product_ids) in enumerate(collections):
+        variables[f"id{i}"] = f"gid://shopify/Collection/{collection_id}"
+        variables[f"productIds{i}"] = product_ids
+        declarations.append(f"$id{i}: ID!, $productIds{i}: [ID!]!")
+        mutations.append(
+            f"c{i}: collectionAddProducts(id: $id{i}, productIds: $productIds{i}) "
+            "{ collection { id } userErrors { field message } }"
         )
-    response.raise_for_status()
-    return response.json()['custom_collection']['id']
+    query = f"mutation addProductsToCollections({', '.join(declarations)}) {{ {' '.join(mutations)} }}"
+    data = shopify_graphql(query, variables)
+    for i, (collection_id, product_ids) in enumerate(collections):
+        user_errors = data[f"c{i}"]['userErrors']
+        if user_errors:
+            app.logger.error(f"Failed to add products to collection {collection_id}: {user_errors}")
+        else:
+            app.logger.info("Added %d products to collection %s", len(product_ids), collection_id)
+
+# Products are added to collections in batches: every product created during
+# the window that belongs to the same collection goes into one mutation
+collect_queue = BatchQueue(
+    add_products_to_collections,
+    window=float(os.getenv('COLLECT_BATCH_WINDOW', 2.0)),
+    max_size=int(os.getenv('COLLECT_BATCH_SIZE', 250))
+)
+atexit.register(collect_queue.flush)
 
 def add_product_to_collection(product_id, collection_id):
-    """Add a product to a Shopify collection"""
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": ACCESS_TOKEN
-    }
-    payload = {
-        "collect": {
-            "product_id": product_id,
-            "collection_id": collection_id
-        }
-    }
-    response = requests.post(
-        f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/collects.json",
-        json=payload,
-        headers=headers
-    )
-    response.raise_for_status()
+    """Queue a product to be added to a Shopify collection"""
+    return collect_queue.add((collection_id, product_id), (collection_id, product_id))
+
+def get_tag_collection_id(tag):
+    """Return the id of the collection for a tag, creating it if needed"""
+    return create_or_update_collection(f"{tag} Parts", tag)
+
+def add_product_to_tag_collection(product_id, tag):
+    """Add a product to the collection for a tag, creating it if needed"""
+    collection_title = f"{tag} Parts"
+    collection_id = get_tag_collection_id(tag)
+    future = add_product_to_collection(product_id, collection_id)
+    app.logger.info("Queued product %s for collection: %s", product_id, collection_title)
+    return future
+
+def update_product_tags(updates):
+    """Set the tags of several products with one aliased productUpdate mutation"""
+    variables = {}
+    declarations = []
+    mutations = []
+    for i, (product_id, tags) in enumerate(updates):
+        variables[f"input{i}"] = {"id": f"gid://shopify/Product/{product_id}", "tags": list(tags)}
+        declarations.append(f"$input{i}: ProductInput!")
+        mutations.append(
+            f"p{i}: productUpdate(input: $input{i}) {{ product {{ id }} userErrors {{ field message }} }}"
+        )
+    query = f"mutation updateProductTags({', '.join(declarations)}) {{ {' '.join(mutations)} }}"
+    data = shopify_graphql(query, variables)
+    for i, (product_id, tags) in enumerate(updates):
+        user_errors = data[f"p{i}"]['userErrors']
+        if user_errors:
+            app.logger.error(f"Failed to update tags of product {product_id}: {user_errors}")
+        else:
+            app.logger.info("Updated product %s with tags: %s", product_id, tags)
+
+# Tag updates from webhooks that arrive close together (bulk imports) are sent
+# as one GraphQL request, which fits Shopify's cost-based rate limit far better
+# than one REST PUT per product
+product_update_queue = BatchQueue(
+    update_product_tags,
+    window=float(os.getenv('PRODUCT_UPDATE_BATCH_WINDOW', 0.05)),
+    max_size=int(os.getenv('PRODUCT_UPDATE_BATCH_SIZE', 25))
+)
+atexit.register(product_update_queue.flush)
+
+def get_collection_tags(tags):
+    """Return the tags that get their own collection (the multi-word ones)"""
+    return [tag for tag in tags if " " in tag]
+
+def tag_product(product_id, tags, futures):
+    """Queue the tag and collection updates of a Shopify product.
+
+    The futures of the queued batch items are appended to `futures` as they are
+    queued, so the caller can watch them even if a collection lookup or
+    creation fails; the first such failure is re-raised once every tag is done.
+    """
+    futures.append(product_update_queue.add(product_id, (product_id, tags)))
+
+    tasks = [
+        collection_executor.submit(add_product_to_tag_collection, product_id, tag)
+        for tag in get_collection_tags(tags)
+    ]
+    error = None
+    for task in tasks:
+        try:
+            futures.append(task.result())
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+
+def log_tagging_failure(product_id, future):
+    """Log a failed batch update of a product once its batch has been sent"""
+    e = future.exception()
+    if e is None:
+        return
+    if isinstance(e, requests.exceptions.RequestException):
+        app.logger.error(f"Shopify API error while tagging product {product_id}: {str(e)}")
+    else:
+        app.logger.error(f"Unexpected error while tagging product {product_id}: {str(e)}")
+
+def tag_product_in_background(product_id, tags):
+    """Run tag_product on the in-process pool, logging failures"""
+    futures = []
+    try:
+        tag_product(product_id, tags, futures)
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Shopify API error while tagging product {product_id}: {str(e)}")
+    except Exception as e:
+        app.logger.error(f"Unexpected error while tagging product {product_id}: {str(e)}")
+    # Batches are sent later by their queues; don't hold the worker until then.
+    # Items queued before a failure still get their failures logged.
+    for future in futures:
+        future.add_done_callback(functools.partial(log_tagging_failure, product_id))
+
+def tag_product_job(product_id, tags):
+    """RQ job: tag a product, letting failures propagate so RQ retries them"""
+    # RQ runs each job in a short-lived process, so the mutations are sent
+    # directly for this product instead of going through the batch queues
+    update_product_tags([(product_id, tags)])
+    collection_ids = list(collection_executor.map(get_tag_collection_id, get_collection_tags(tags)))
+    if collection_ids:
+        add_products_to_collections([(collection_id, product_id) for collection_id in collection_ids])
+
+def json_response(payload, status=200):
+    """Build a JSON response with orjson, which encodes much faster than jsonify"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
 
 @app.route("/webhook/products/create", methods=["POST"])
 def handle_product_create():
@@ -233,61 +781,55 @@ def handle_product_create():
     hmac_header = request.headers.get('X-Shopify-Hmac-Sha256')
     if not hmac_header:
         app.logger.error("Missing X-Shopify-Hmac-Sha256 header")
-        return jsonify({"error": "Missing HMAC header"}), 401
+        return json_response({"error": "Missing HMAC header"}, 401)
 
-    data = request.get_data()
-    if not verify_webhook(data, hmac_header):
+    # Read the body once; it is parsed only after the signature checks out
+    raw_body = request.get_data(cache=False)
+    if not verify_webhook(raw_body, hmac_header):
         app.logger.error("Webhook verification failed")
-        return jsonify({"error": "Webhook verification failed"}), 401
+        return json_response({"error": "Webhook verification failed"}, 401)
 
     try:
-        data = request.get_json()
-        app.logger.info(f"Webhook data: {data}")
-        if not data or 'id' not in data:
+        try:
+            data = orjson.loads(raw_body)
+        except orjson.JSONDecodeError:
+            app.logger.error("Invalid request: Body is not valid JSON")
+            return json_response({"error": "Invalid request"}, 400)
+        app.logger.info("Webhook data: %s", data)
+        if not isinstance(data, dict) or 'id' not in data:
             app.logger.error("Invalid request: Missing product ID")
-            return jsonify({"error": "Invalid request"}), 400
+            return json_response({"error": "Invalid request"}, 400)
 
         product_id = data['id']
         title = data.get('title', '')
+        # The non-vehicle check lives here only, so skipped titles cost no
+        # extraction, tag cache or Shopify work
+        if not title or is_non_vehicle_title(title):
+            app.logger.info("Skipping non-vehicle product title")
+            return json_response({"status": "success", "tags": []})
         
-        vehicle_data = extract_vehicle_data(title)
-        tags = get_vehicle_tags(vehicle_data)
-        app.logger.info(f"Generated tags: {tags}")
+        tags = compute_tags(title)
+        app.logger.info("Generated tags: %s", tags)
         
         if tags:
-            headers = {
-                "Content-Type": "application/json",
-                "X-Shopify-Access-Token": ACCESS_TOKEN
-            }
-            payload = {
-                "product": {
-                    "id": product_id,
-                    "tags": ", ".join(tags)
-                }
-            }
-            response = requests.put(
-                f"https://{SHOPIFY_DOMAIN}/admin/api/2023-10/products/{product_id}.json",
-                json=payload,
-                headers=headers
-            )
-            response.raise_for_status()
-            app.logger.info(f"Updated product {product_id} with tags: {tags}")
+            # Acknowledge right away; Shopify retries webhooks that are slow to answer
+            if webhook_queue is not None:
+                # Enqueued by name: under `python app.py` the function lives in
+                # __main__, which RQ workers cannot import
+                webhook_queue.enqueue(
+                    'app.tag_product_job', product_id, tags,
+                    job_timeout=120,
+                    retry=JobRetry(max=3, interval=[10, 30, 60])
+                )
+            else:
+                webhook_executor.submit(tag_product_in_background, product_id, tags)
+            return json_response({"status": "queued", "tags": tags}, 202)
 
-            for tag in tags:
-                if " " in tag:
-                    collection_title = f"{tag} Parts"
-                    collection_id = create_or_update_collection(collection_title, tag)
-                    add_product_to_collection(product_id, collection_id)
-                    app.logger.info(f"Added product {product_id} to collection: {collection_title}")
-            
-        return jsonify({"status": "success", "tags": tags}), 200
+        return json_response({"status": "success", "tags": tags})
 
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Shopify API error: {str(e)}")
-        return jsonify({"error": "Failed to update product"}), 500
     except Exception as e:
         app.logger.error(f"Unexpected error: {str(e)}")
-        return jsonify({"error": "Internal server error"}), 500
+        return json_response({"error": "Internal server error"}, 500)
 
 @app.route("/")
 def home():
@@ -296,5 +838,6 @@ def home():
     return "Vehicle AutoTagger Service"
 
 if __name__ == "__main__":
+    # Local development only; production runs under gunicorn (see gunicorn.conf.py)
     port = int(os.getenv('PORT', 5002))
-    app.run(host='0.0.0.0', port=port, debug=os.getenv('FLASK_DEBUG', 'False') == 'True')
+    app.run(host='0.0.0.0', port=port, debug=FLASK_DEBUG)
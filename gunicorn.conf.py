@@ -0,0 +1,27 @@
+# Gunicorn settings for production: gunicorn app:app
+# Webhook handlers spend most of their time waiting on the Shopify API, so
+# gevent workers let each process keep many requests in flight at once.
+import multiprocessing
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gevent':
+    # With preload_app the app is imported in the master, before the workers
+    # would patch, so patch here to make the imported modules cooperative
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5002)}"
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Import the app (config, compiled patterns, vehicle index) once in the master
+# and fork the workers from it instead of repeating the startup in each one
+preload_app = True
+
+def post_fork(server, worker):
+    # Database connections opened while preloading must not be shared with
+    # the parent, so give each worker a fresh connection pool
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -0,0 +1,193 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+# No config file here, so the app falls back to its default configuration
+os.environ.setdefault('CONFIG_PATH', os.path.join(TESTS_DIR, 'missing-config.json'))
+os.environ.setdefault('SHOPIFY_DOMAIN', 'shop.example')
+os.environ.setdefault('SHOPIFY_ACCESS_TOKEN', 'token')
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import orjson  # noqa: E402
+import requests  # noqa: E402
+
+import app  # noqa: E402
+
+
+def graphql_response(body, status=200, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response._content = orjson.dumps(body)
+    return response
+
+
+class BatchQueueTest(unittest.TestCase):
+
+    def test_flush_sends_queued_items_together(self):
+        sent = []
+        queue = app.BatchQueue(sent.append, window=60, max_size=10)
+        first = queue.add('a', 1)
+        second = queue.add('b', 2)
+        queue.flush()
+        self.assertEqual(sent, [[1, 2]])
+        self.assertIsNone(first.result(timeout=1))
+        self.assertIsNone(second.result(timeout=1))
+
+    def test_later_item_with_same_key_replaces_earlier_one(self):
+        sent = []
+        queue = app.BatchQueue(sent.append, window=60, max_size=10)
+        first = queue.add('a', 1)
+        second = queue.add('a', 2)
+        queue.flush()
+        self.assertEqual(sent, [[2]])
+        self.assertTrue(first.done())
+        self.assertTrue(second.done())
+
+    def test_reaching_max_size_flushes_immediately(self):
+        sent = []
+        queue = app.BatchQueue(sent.append, window=60, max_size=2)
+        queue.add('a', 1)
+        queue.add('b', 2)
+        self.assertEqual(sent, [[1, 2]])
+
+    def test_failed_flush_is_reported_to_every_item(self):
+        error = requests.exceptions.ConnectionError('unreachable')
+        queue = app.BatchQueue(mock.Mock(side_effect=error), window=60, max_size=10)
+        futures = [queue.add('a', 1), queue.add('b', 2)]
+        queue.flush()
+        for future in futures:
+            self.assertIs(future.exception(timeout=1), error)
+
+
+class GraphQLBatchTest(unittest.TestCase):
+
+    def test_update_product_tags_sends_aliased_mutations(self):
+        data = {'p0': {'userErrors': []}, 'p1': {'userErrors': []}}
+        with mock.patch.object(app, 'shopify_graphql', return_value=data) as graphql:
+            app.update_product_tags([(1, ('BMW', 'E90')), (2, ('Audi',))])
+        query, variables = graphql.call_args.args
+        self.assertIn('p0: productUpdate(input: $input0)', query)
+        self.assertIn('p1: productUpdate(input: $input1)', query)
+        self.assertEqual(variables['input0'], {'id': 'gid://shopify/Product/1', 'tags': ['BMW', 'E90']})
+        self.assertEqual(variables['input1'], {'id': 'gid://shopify/Product/2', 'tags': ['Audi']})
+
+    def test_add_products_to_collections_groups_products_by_collection(self):
+        data = {'c0': {'userErrors': []}, 'c1': {'userErrors': []}}
+        with mock.patch.object(app, 'shopify_graphql', return_value=data) as graphql:
+            app.add_products_to_collections([(10, 1), (20, 1), (10, 2)])
+        self.assertEqual(graphql.call_count, 1)
+        query, variables = graphql.call_args.args
+        self.assertIn('c0: collectionAddProducts(id: $id0, productIds: $productIds0)', query)
+        self.assertEqual(variables['id0'], 'gid://shopify/Collection/10')
+        self.assertEqual(variables['productIds0'], ['gid://shopify/Product/1', 'gid://shopify/Product/2'])
+        self.assertEqual(variables['id1'], 'gid://shopify/Collection/20')
+        self.assertEqual(variables['productIds1'], ['gid://shopify/Product/1'])
+
+    def test_add_products_to_collections_limits_collections_per_request(self):
+        def reply(query, variables):
+            return {f"c{i}": {'userErrors': []} for i in range(len(variables) // 2)}
+
+        collects = [(collection_id, 1) for collection_id in range(7)]
+        with mock.patch.object(app, 'COLLECTIONS_PER_REQUEST', 3), \
+                mock.patch.object(app, 'shopify_graphql', side_effect=reply) as graphql:
+            app.add_products_to_collections(collects)
+        self.assertEqual([len(call.args[1]) // 2 for call in graphql.call_args_list], [3, 3, 1])
+
+    def test_add_products_to_collections_sends_every_chunk_before_raising(self):
+        error = requests.exceptions.RequestException('GraphQL errors')
+        replies = [error, {'c0': {'userErrors': []}}]
+        with mock.patch.object(app, 'COLLECTIONS_PER_REQUEST', 1), \
+                mock.patch.object(app, 'shopify_graphql', side_effect=replies) as graphql:
+            with self.assertRaises(requests.exceptions.RequestException):
+                app.add_products_to_collections([(10, 1), (20, 1)])
+        self.assertEqual(graphql.call_count, 2)
+
+    def test_shopify_graphql_retries_throttled_requests(self):
+        throttled = graphql_response({
+            'errors': [{'message': 'Throttled', 'extensions': {'code': 'THROTTLED'}}],
+            'extensions': {'cost': {'requestedQueryCost': 60,
+                                    'throttleStatus': {'currentlyAvailable': 10, 'restoreRate': 50.0}}},
+        })
+        ok = graphql_response({'data': {'p0': {'userErrors': []}}})
+        with mock.patch.object(app.shopify_session, 'post', side_effect=[throttled, ok]) as post, \
+                mock.patch.object(app.time, 'sleep') as sleep:
+            data = app.shopify_graphql('mutation', {})
+        self.assertEqual(data, {'p0': {'userErrors': []}})
+        self.assertEqual(post.call_count, 2)
+        sleep.assert_called_once_with(1.0)
+
+    def test_shopify_graphql_retries_rate_limited_requests(self):
+        limited = graphql_response({}, status=429, headers={'Retry-After': '2'})
+        ok = graphql_response({'data': {}})
+        with mock.patch.object(app.shopify_session, 'post', side_effect=[limited, ok]), \
+                mock.patch.object(app.time, 'sleep') as sleep:
+            self.assertEqual(app.shopify_graphql('mutation', {}), {})
+        sleep.assert_called_once_with(2.0)
+
+    def test_shopify_graphql_raises_other_errors(self):
+        failed = graphql_response({'errors': [{'message': 'Field does not exist'}]})
+        with mock.patch.object(app.shopify_session, 'post', return_value=failed) as post:
+            with self.assertRaises(requests.exceptions.RequestException):
+                app.shopify_graphql('mutation', {})
+        self.assertEqual(post.call_count, 1)
+
+
+class TagProductTest(unittest.TestCase):
+
+    def test_failed_collection_keeps_futures_of_queued_items(self):
+        update_future, collect_future = mock.sentinel.update, mock.sentinel.collect
+        error = requests.exceptions.RequestException('collection lookup failed')
+
+        def add_to_collection(product_id, tag):
+            if tag == 'BMW E90':
+                raise error
+            return collect_future
+
+        queue = mock.Mock(add=mock.Mock(return_value=update_future))
+        futures = []
+        with mock.patch.object(app, 'product_update_queue', queue), \
+                mock.patch.object(app, 'add_product_to_tag_collection', side_effect=add_to_collection):
+            with self.assertRaises(requests.exceptions.RequestException):
+                app.tag_product(1, ('BMW', 'BMW E90', 'BMW E90 320d'), futures)
+        self.assertEqual(futures, [update_future, collect_future])
+
+
+class VehicleIndexExpiryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app.app_context()
+        self.context.push()
+        app.load_vehicle_index()
+
+    def tearDown(self):
+        app.db.session.rollback()
+        app.Vehicle.query.filter_by(brand='Testbrand').delete()
+        app.db.session.commit()
+        self.context.pop()
+
+    def add_vehicle(self):
+        app.db.session.add(app.Vehicle(brand='Testbrand', model='TB1', type='X', engine_code='TB10'))
+        app.db.session.flush()
+
+    def test_rolled_back_write_keeps_the_index(self):
+        loaded_at = app.vehicle_index_loaded_at
+        self.add_vehicle()
+        app.db.session.rollback()
+        self.assertEqual(app.vehicle_index_loaded_at, loaded_at)
+
+    def test_committed_write_expires_the_index(self):
+        self.add_vehicle()
+        app.db.session.commit()
+        self.assertEqual(app.vehicle_index_loaded_at, float('-inf'))
+        app.compute_tags('Testbrand TB1 X')
+        self.assertNotEqual(app.vehicle_index_loaded_at, float('-inf'))
+        self.assertIn(('testbrand', 'tb1', 'x'), app.vehicle_index)
+
+
+if __name__ == '__main__':
+    unittest.main()